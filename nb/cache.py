@@ -0,0 +1,171 @@
+# cache.py - Shared analysis cache, rcampbel@purdue.edu, Oct 2023
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+from nb.log import log
+from nb.config import CACHE_MAX_BYTES, CACHE_TMP_MAX_AGE
+
+VERSION = 3  # Bump when layout of cached data changes
+LOCK_FILE = '.lock'
+FRAME_EXT = '.npz'
+RESULT_EXT = '.json'
+TMP_EXT = '.tmp'
+
+def digest(path, chunk_size=1024*1024):
+    """Hash file contents."""
+    sha = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+def key(*parts):
+    """Create cache key from upload hash, options, rules version, etc."""
+    return hashlib.sha256(repr((VERSION,) + parts).encode()).hexdigest()
+
+def cache_dir(project):
+    return shared_dir(os.path.join(project.base, project.cache_dir))
+
+def shared_dir(path):
+    """Create dir, if needed, writable by all project group members."""
+    if not os.path.isdir(path):
+        os.makedirs(path, mode=0o2775, exist_ok=True)
+
+        if os.stat(path).st_uid == os.getuid():
+            os.chmod(path, 0o2775)  # NOTE makedirs applies umask
+
+    return path
+
+@contextmanager
+def locked(path, exclusive):
+    """Hold file lock on dir (shared by all hub sessions)."""
+    fd = os.open(os.path.join(path, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o664)
+
+    try:
+        if os.fstat(fd).st_uid == os.getuid():
+            os.fchmod(fd, 0o664)  # NOTE os.open applies umask
+
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+def get_frame(project, cache_key):
+    """Load parsed frame, or None if not cached."""
+    path = os.path.join(cache_dir(project), cache_key+FRAME_EXT)
+
+    try:
+        with locked(cache_dir(project), False), np.load(path, allow_pickle=False) as data:
+            columns = json.loads(str(data['columns']))
+            df = pd.DataFrame({i: pd.Categorical.from_codes(data[f'codes{i}'], data[f'cats{i}'].tolist())
+                               for i in range(len(columns))})
+            os.utime(path)  # Mark as recently used
+    except FileNotFoundError:
+        return None
+    except Exception:
+        log.warning(f'Unreadable cache entry "{path}", ignoring')
+        return None
+
+    df.columns = columns
+    return df
+
+def put_frame(project, cache_key, df, columns):
+    """Store parsed frame (category columns) as codes & labels, w/given column names. Writes in background."""
+    arrays = {'columns': np.array(json.dumps(columns))}
+
+    for i, col in enumerate(df.columns):
+        arrays[f'codes{i}'] = df.iloc[:, i].cat.codes.to_numpy()
+        arrays[f'cats{i}'] = np.array(df.iloc[:, i].cat.categories.astype(str), dtype=str)
+
+    size = sum(array.nbytes for array in arrays.values())
+
+    def write_frame():
+        try:
+            write(project, cache_key+FRAME_EXT, lambda f: np.savez(f, **arrays), size)
+        except Exception as e:
+            log.warning(f'Could not cache parsed data: "{e}"')
+
+    threading.Thread(target=write_frame, daemon=True).start()
+
+def get_result(project, cache_key):
+    """Load analysis results, or None if not cached."""
+    path = os.path.join(cache_dir(project), cache_key+RESULT_EXT)
+
+    try:
+        with locked(cache_dir(project), False), open(path) as f:
+            result = json.load(f)
+            os.utime(path)  # Mark as recently used
+    except FileNotFoundError:
+        return None
+    except Exception:
+        log.warning(f'Unreadable cache entry "{path}", ignoring')
+        return None
+
+    return result
+
+def put_result(project, cache_key, result):
+    """Store analysis results."""
+    data = json.dumps(result).encode()
+    write(project, cache_key+RESULT_EXT, lambda f: f.write(data), len(data))
+
+def write(project, name, write_func, size):
+    """Write cache entry (approx. size bytes) atomically, then enforce size limit."""
+    if size > CACHE_MAX_BYTES:
+        log.debug(f'write(), "{name}" too big to cache ({size} bytes)')
+        return
+
+    path = cache_dir(project)
+
+    with locked(path, True):
+        fd, tmp = tempfile.mkstemp(dir=path, suffix=TMP_EXT)
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write_func(f)
+
+            os.chmod(tmp, 0o664)  # Let other project members reuse entry
+            os.replace(tmp, os.path.join(path, name))
+        except Exception:
+            os.remove(tmp)
+            raise
+
+        evict(path)
+
+def evict(path):
+    """Remove least recently used entries until cache is under size limit, and stale partly written entries."""
+    entries = []
+
+    for entry in os.scandir(path):
+
+        if entry.name.endswith(TMP_EXT) and entry.stat().st_mtime < time.time() - CACHE_TMP_MAX_AGE:
+            os.remove(entry.path)
+            log.debug(f'evict(), removed "{entry.path}"')
+
+        elif entry.name.endswith((FRAME_EXT, RESULT_EXT)):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+
+    for _, size, entry_path in sorted(entries):
+
+        if total <= CACHE_MAX_BYTES:
+            break
+
+        os.remove(entry_path)
+        total -= size
+        log.debug(f'evict(), removed "{entry_path}"')
@@ -24,6 +24,12 @@ OVR = '-OVERRIDE-'
 
 NUM_PREVIEW_ROWS = 3
 COL_DDN_WIDTH = '140px'
+GUESS_MIN_SCORE = 0.5  # Warn if best matching model scores lower (0-1)
+GUESS_MARGIN = 0.05  # Warn if next best model scores within this margin
+EXPORT_CHUNK_ROWS = 100000  # Rows written per chunk when saving submission
+INDEX_CHUNK_ROWS = 1000000  # Rows read per chunk when indexing project's merged data
+CACHE_MAX_BYTES = 2 * 1024**3  # Shared analysis cache size limit, least recently used entries evicted first
+CACHE_TMP_MAX_AGE = 3600  # Seconds before partly written cache entry (e.g. from killed kernel) is removed
 
 @dataclass
 class Project:
@@ -34,6 +40,8 @@ class Project:
     submit_dir: str
     pending_dir: str
     merge_file: str
+    cache_dir: str
+    index_dir: str
 
 
 @dataclass
@@ -48,11 +56,15 @@ cfg = Config(
                           rule_file='.rules/RuleTables.xlsx',
                           submit_dir='.submissions/',
                           pending_dir='.submissions/.pending/',
-                          merge_file='AgClim50IV.csv'),
+                          merge_file='AgClim50IV.csv',
+                          cache_dir='.cache/',
+                          index_dir='.index/'),
                   Project(name='data',
                           group='pr-agmipglobalecondata',
                           base='/data/projects/agmipglobalecondata/files/',
                           rule_file='.rules/RuleTables.xlsx',
                           submit_dir='.submissions/',
                           pending_dir='.submissions/.pending/',
-                          merge_file='Data.csv')])
+                          merge_file='Data.csv',
+                          cache_dir='.cache/',
+                          index_dir='.index/')])
@@ -1,12 +1,17 @@
 # controller.py - App logic, rcampbel@purdue.edu, Oct 2023
+import getpass
 import logging
 import os
 import sys
+import threading
 import traceback
+from datetime import datetime
+from functools import partial
 from fuzzywuzzy import fuzz, process
-from nb import model, view
+from nb import model, store, view
 from nb.config import cfg, SCN, REG, VAR, HDR, DEL, OVR, SUBMISSION, \
-                      INTEGRITY, PLAUSIBILITY, FINISH, NUM_PREVIEW_ROWS, COL_DDN_WIDTH 
+                      INTEGRITY, PLAUSIBILITY, FINISH, NUM_PREVIEW_ROWS, COL_DDN_WIDTH, \
+                      GUESS_MIN_SCORE, GUESS_MARGIN
 from nb.log import log, log_handler
 
 ctrl = sys.modules[__name__]
@@ -21,6 +26,11 @@ def start(debug=False):
         # Find user's projects
 
         ctrl.user_projects = []
+        ctrl.model_placeholder = None  # Model menu value until guessed
+        ctrl.guess_lock = threading.Lock()  # One model guess at a time
+        ctrl.guess_request = 0  # Latest model guess request (older ones are dropped)
+        ctrl.guess_select = False  # Pending request to preselect guessed model
+        ctrl.guess_failed = set()  # Names of projects whose models couldn't be ranked (warned once)
 
         for user_group in os.popen('groups').read().strip('\n').split(' '):
 
@@ -76,18 +86,11 @@ def when_stack_changes(change):
                 when_refresh_preview()
             
             elif change['new'] == view.steps.index(INTEGRITY):
-                model.set_columns({i+1:ddn.value for i, ddn in enumerate(ctrl.col_ddns)})  # +1 to skip model   
+                model.set_columns(ctrl.col_map())   
                 model.analyze()  
 
                 # Display analysis results
 
-                # Row counts
-                view.struct_probs_int.value = str(model.num_rows_with_nan )
-                view.ignored_scens_int.value = str(model.num_rows_ignored_scens)
-                view.dupes_int.value = str(model.duplicate_rows)
-                view.accepted_int.value = str(model.num_rows_read - model.num_rows_with_nan - 
-                                            model.num_rows_ignored_scens - model.duplicate_rows )
-
                 # Bad labels
 
                 bad_grid_widgets = [view.title('Column'), view.title('Label'), view.title('Fix (applied automatically)')] 
@@ -101,12 +104,20 @@ def when_stack_changes(change):
 
                 unknown_grid_widgets = [view.title('Column'), view.title('Label'), view.title('Fix (select from menu)')]
 
+                model.tally_reset()
+
                 for col, lbl, match in model.unknown_labels:
                     ddn = view.cell_ddn(DEL if match is None else match, [DEL, OVR] + model.get_valid(col))
+                    ddn.observe(partial(ctrl.when_fix_selected, col, lbl), 'value')
+                    model.tally(col, lbl, ddn.value)
                     unknown_grid_widgets += [view.cell(col), view.cell(lbl), ddn]
 
                 view.unknown_grid.children = unknown_grid_widgets 
 
+                # Row counts
+                view.ignored_scens_int.value = str(model.num_rows_ignored_scens)
+                refresh_row_counts()
+
             elif change['new'] == view.steps.index(PLAUSIBILITY):
                 # Apply fixes TODO Remove records with struct problems
 
@@ -144,6 +155,22 @@ def when_stack_changes(change):
         log.error('when_stack_changes, change={change}:\n'+traceback.format_exc())
         raise
 
+def when_fix_selected(col, lbl, change):
+    """React to user choosing fix for unknown label."""
+    try:
+        model.tally(col, lbl, change['new'])
+        refresh_row_counts()
+    except Exception:
+        log.error('when_fix_selected:\n'+traceback.format_exc())
+
+def refresh_row_counts():
+    """Show row counts, incl. effect of currently chosen fixes."""
+    nans, dupes, deleted, accepted = model.row_counts()
+    view.struct_probs_int.value = str(nans)
+    view.dupes_int.value = str(dupes)
+    view.deleted_int.value = str(deleted)
+    view.accepted_int.value = str(accepted)
+
 def when_upload_completed(names=None):
     """React to user uploading file."""
     # NOTE Callback to this method registered in view
@@ -154,6 +181,9 @@ def when_upload_completed(names=None):
         if model.detect_delim():
             view.delim_ddn.value = model.detected_delim
             model.read_file(delim=view.delim_ddn.value)
+
+            if model.project is not None:
+                ctrl.start_guess(select=True)
     
     except Exception:
         view.file_info.value = '(UPLOAD ERROR)'
@@ -165,10 +195,13 @@ def when_project_selected(_=None):
         if view.project.value is not None:
             model.load_rules(view.project.value)  # Read rules file
 
+            threading.Thread(target=ctrl.prep_project, args=(view.project.value,), daemon=True).start()
+
             # Set model dropdown menu
             ctrl.observe_activate(False, ctrl.col_ddns, ctrl.when_refresh_preview)
             view.model_ddn.options = model.all_models()
-            view.model_ddn.value = view.model_ddn.options[0]  # TODO Guess model 
+            view.model_ddn.value = view.model_ddn.options[0]  # NOTE Until guessed, see prep_project()
+            ctrl.model_placeholder = view.model_ddn.value
             ctrl.observe_activate(True, ctrl.col_ddns, ctrl.when_refresh_preview)
         
     except Exception:
@@ -274,19 +307,138 @@ def when_refresh_preview(_=None):
             for c in range(len(HDR[1:])):  # +1 to skip model  
                 view.out_grid.children[r*len(HDR)+c+1].value = str(model.df.iloc[r, c+1])  
 
+        ctrl.start_guess()  # Check model selection
+
+def col_map():
+    """Get column assignments, {HDR index: upload column position}, or None if not assigned yet."""
+    if any(ddn.value is None for ddn in ctrl.col_ddns):
+        return None
+
+    return {i+1:ddn.value for i, ddn in enumerate(ctrl.col_ddns)}  # +1 to skip model
+
+def prep_project(project):
+    """Open (index, if needed) project's merged data, then guess model for upload."""
+    try:
+        store.load(project)
+        ctrl.start_guess(select=True)
+    except Exception:
+        log.error('prep_project:\n'+traceback.format_exc())
+
+def start_guess(select=False):
+    """Guess model in background, superseding earlier guesses."""
+    ctrl.guess_request += 1
+    ctrl.guess_select = ctrl.guess_select or select
+    threading.Thread(target=ctrl.guess_model, args=(ctrl.guess_request, model.upload_digest), daemon=True).start()
+
+def guess_model(request, upload_digest):
+    """Rank models by similarity to upload, preselect best if requested, warn if match is weak, ambiguous or not selected."""
+    with ctrl.guess_lock:
+        try:
+            if request != ctrl.guess_request or model.df is None or model.project is None:
+                return  # Superseded or nothing to guess yet
+
+            try:
+                ranking = model.rank_models(ctrl.col_map())
+                ctrl.guess_failed.discard(model.project.name)
+            except Exception as e:
+                view.model_hint_lbl.value = ''
+
+                if model.project.name not in ctrl.guess_failed:
+                    ctrl.guess_failed.add(model.project.name)
+                    log.warning(f'Cannot guess model for "{model.project.name}": "{e}"')
+
+                return
+
+            if request != ctrl.guess_request:
+                return  # Superseded while ranking
+
+            if len(ranking) == 0:
+                view.model_hint_lbl.value = ''
+                return
+
+            score, best = ranking[0]
+            select, ctrl.guess_select = ctrl.guess_select, False
+
+            # Preselect only if user hasn't chosen a model, upload is unchanged & submission step isn't done
+            if select and view.model_ddn.value == ctrl.model_placeholder and upload_digest == model.upload_digest \
+                    and view.stack.selected_index <= view.steps.index(SUBMISSION):
+                ctrl.observe_activate(False, [view.model_ddn], ctrl.when_refresh_preview)
+                view.model_ddn.value = best
+                ctrl.observe_activate(True, [view.model_ddn], ctrl.when_refresh_preview)
+
+                if model.df is not None:
+
+                    for r in range(1, NUM_PREVIEW_ROWS):  # 1 to skip header
+                        view.out_grid.children[r*len(HDR)+0].value = str(best)  # Model
+
+            show_model_hint(ranking)
+        except Exception:
+            log.error('guess_model:\n'+traceback.format_exc())
+
+def show_model_hint(ranking):
+    """Show best matching model, warn if match is weak, ambiguous or not selected."""
+    score, best = ranking[0]
+    warnings = []
+
+    if score < GUESS_MIN_SCORE:
+        warnings.append('weak match')
+
+    if len(ranking) > 1 and score - ranking[1][0] < GUESS_MARGIN:
+        warnings.append(f'"{ranking[1][1]}" matches nearly as well ({ranking[1][0]:.0%})')
+
+    if view.model_ddn.value != best:
+        warnings.append('selected model differs')
+
+    view.model_hint_lbl.value = f'Data best matches model "{best}" ({score:.0%})' + \
+                                ('. WARNING: '+'; '.join(warnings) if warnings else '')
+
 def when_plot(_=None):
     """Display plot."""
     try:
         view.display_plot('Generating plot...')
         series = model.select(view.plot_scen_ddn.value, view.plot_reg_ddn.value, view.plot_var_ddn.value)
-        view.display_plot(series)
+
+        try:
+            bands = model.compare(view.plot_scen_ddn.value, view.plot_reg_ddn.value, view.plot_var_ddn.value,
+                                  view.model_ddn.value)
+        except Exception as e:
+            bands = None
+            log.warning(f'No comparison with other models: "{e}"')
+
+        view.display_plot(series, bands)
     except Exception as e:
         view.display_plot(f'Plot error: "{e}"')
         log.error('when_plot:\n'+traceback.format_exc())
 
 def when_submit(_=None):
     """React to user pressing Submit button."""
-    if ctrl.pending:
-        log.debug('Submit PENDING!')
-    else:
-        log.debug('Submit ACCEPTED!')
+    view.submit_btn.disabled = True
+    threading.Thread(target=ctrl.submit, daemon=True).start()  # Don't block UI while writing
+
+def submit():
+    """Save submission to project's submission (or pending) dir."""
+    try:
+        project = view.project.value
+        status = 'PENDING REVIEW' if ctrl.pending else 'ACCEPTED'
+        submit_dir = os.path.join(project.base, project.pending_dir if ctrl.pending else project.submit_dir)
+        created = datetime.now()
+        path = os.path.join(submit_dir, f'{view.model_ddn.value}-{created.strftime("%Y%m%d-%H%M%S")}.csv')
+        view.activity_out.append_stdout(f'Saving "{os.path.basename(path)}"...\n')
+        manifest = model.export(path, view.model_ddn.value, {'project': project.name, 'status': status, 
+                                                             'user': getpass.getuser(), 'created': created.isoformat()})
+        view.activity_out.append_stdout(f'Submitted "{manifest["file"]}", {manifest["rows"]} records, status: {status}\n')
+        log.info(f'Submitted "{path}", status: {status}')
+
+        if str(manifest['rows']) != view.accepted_int.value:  # E.g. fixes made more duplicates
+            log.warning(f'Submitted {manifest["rows"]} records, {view.accepted_int.value} accepted during integrity check')
+
+        if not ctrl.pending:
+
+            try:
+                model.learn_model(view.model_ddn.value, ctrl.col_map())
+            except Exception as e:
+                log.warning(f'Model fingerprint not updated: "{e}"')
+    except Exception as e:
+        view.activity_out.append_stdout(f'Submission error: "{e}"\n')
+        log.error('submit:\n'+traceback.format_exc())
+        view.submit_btn.disabled = False  # Allow retry
@@ -0,0 +1,181 @@
+# fingerprint.py - Model detection from label sketches, rcampbel@purdue.edu, Oct 2023
+import json
+import os
+import sys
+import tempfile
+import threading
+import zlib
+import numpy as np
+import pandas as pd
+from nb import cache, store
+from nb.log import log
+from nb.config import HDR, MOD, REG, VAR, ITM, VAL
+
+SKETCH_COLS = [REG, VAR, ITM]
+NUM_HASHES = 64  # MinHash sketch size
+PRIME = (1 << 31) - 1
+MAX_LABELS = 10000  # Skip (likely value) columns w/more unique labels when columns are unknown
+LABEL_WEIGHT = 0.75  # Share of score from label similarity, rest from value magnitudes
+FILE_SUFFIX = '-fingerprints.json'
+
+fp = sys.modules[__name__]
+fp.loaded = {}  # Project name -> (file mtime, merged data signature, fingerprints per model)
+fp.lock = threading.Lock()
+
+_rng = np.random.RandomState(0)  # NOTE Fixed seed: sketches must be comparable across sessions
+_a = _rng.randint(1, PRIME, NUM_HASHES).astype(np.uint64)
+_b = _rng.randint(0, PRIME, NUM_HASHES).astype(np.uint64)
+
+def sketch(labels):
+    """MinHash sketch of label set."""
+    hashes = np.array([zlib.crc32(str(label).encode()) for label in labels], dtype=np.uint64) % PRIME
+
+    if len(hashes) == 0:
+        return np.full(NUM_HASHES, PRIME, dtype=np.uint64)
+
+    return ((_a[:, None] * hashes[None, :] + _b[:, None]) % PRIME).min(axis=1)
+
+def similarity(sketch1, sketch2):
+    """Estimate Jaccard similarity of two label sets."""
+    return float(np.mean((sketch1 == sketch2) & (sketch1 < PRIME)))
+
+def magnitudes(keys, variables, values):
+    """Count & mean of log10(|value|) per key & variable."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logs = np.log10(np.abs(values))
+
+    frame = pd.DataFrame({'key': keys, 'var': variables, 'log': logs})[np.isfinite(logs)]
+    stats = frame.groupby(['key', 'var'], observed=True)['log'].agg(['count', 'mean'])
+    result = {}
+
+    for (key, var), (count, mean) in stats.iterrows():
+        result.setdefault(key, {})[str(var)] = [int(count), float(mean)]
+
+    return result
+
+def path(project):
+    _, index_dir, store_path = store.paths(project)
+    return index_dir, store_path+FILE_SUFFIX
+
+def load(project):
+    """Get fingerprints per model, (re)building them from merged data if it has changed."""
+    data = store.load(project)
+    index_dir, prints_path = path(project)
+
+    with fp.lock:
+        mtime = os.stat(prints_path).st_mtime_ns if os.path.exists(prints_path) else None
+        loaded = fp.loaded.get(project.name)
+
+        if loaded is not None and loaded[:2] == (mtime, data['meta']['source']):
+            return loaded[2]
+
+        with cache.locked(index_dir, True):
+            prints = read(prints_path)
+
+            if prints is None or prints['source'] != data['meta']['source']:
+                prints = {'source': data['meta']['source'], 'models': build(data)}
+                write(prints_path, prints)
+
+            models = {name: decode(prints['models'][name]) for name in prints['models']}
+            fp.loaded[project.name] = (os.stat(prints_path).st_mtime_ns, prints['source'], models)
+
+        return models
+
+def build(data):
+    """Fingerprint each model's data in project's store."""
+    log.info('Fingerprinting models...')
+    cats = {col: pd.CategoricalDtype(cat) for col, cat in data['meta']['categories'].items()}
+    models = pd.Categorical.from_codes(np.asarray(data['arrays'][MOD]), dtype=cats[MOD])
+    prints = {str(name): {'sketches': {}, 'magnitudes': {}} for name in models.unique().dropna()}
+
+    for col in SKETCH_COLS:
+        labels = pd.Categorical.from_codes(np.asarray(data['arrays'][col]), dtype=cats[col])
+        pairs = pd.DataFrame({MOD: models, col: labels}).dropna().drop_duplicates()
+
+        for name, group in pairs.groupby(MOD, observed=True):
+            prints[str(name)]['sketches'][col] = sketch(group[col]).tolist()
+
+    variables = pd.Categorical.from_codes(np.asarray(data['arrays'][VAR]), dtype=cats[VAR])
+
+    for name, mags in magnitudes(models, variables, np.asarray(data['arrays'][VAL])).items():
+        prints[str(name)]['magnitudes'] = mags
+
+    return prints
+
+def of_frame(df, col_map=None):
+    """Fingerprint uploaded data. Unknown columns ({HDR index: df column position} not given): sketch all label-like columns."""
+    if col_map is None:
+        columns = [df.iloc[:, i] for i in range(df.shape[1])]
+        candidates = [sketch(col.dropna().unique()) for col in columns if len(col.cat.categories) <= MAX_LABELS]
+        return {'sketches': {col: candidates for col in SKETCH_COLS}, 'magnitudes': {}}
+
+    sketches = {col: [sketch(df.iloc[:, col_map[HDR.index(col)]].dropna().unique())] for col in SKETCH_COLS}
+    values = df.iloc[:, col_map[HDR.index(VAL)]]
+    numbers = np.asarray(pd.to_numeric(pd.Series(values.cat.categories), errors='coerce'), dtype=float)
+    codes = values.cat.codes.to_numpy()
+    numbers = np.where(codes >= 0, np.append(numbers, np.nan)[codes], np.nan)  # NOTE Code -1 (missing) -> nan
+    mags = magnitudes(np.zeros(len(df), dtype=int), df.iloc[:, col_map[HDR.index(VAR)]].to_numpy(), numbers)
+    return {'sketches': sketches, 'magnitudes': mags.get(0, {})}
+
+def decode(model_print):
+    return {'sketches': {col: np.array(s, dtype=np.uint64) for col, s in model_print['sketches'].items()},
+            'magnitudes': model_print['magnitudes']}
+
+def score(model_print, upload_print):
+    """Rate similarity (0-1) of model's past data and upload."""
+    label_score = np.mean([max([similarity(model_print['sketches'][col], s) for s in upload_print['sketches'][col]], default=0)
+                           if col in model_print['sketches'] else 0 for col in SKETCH_COLS])
+    shared = set(model_print['magnitudes']) & set(upload_print['magnitudes'])
+
+    if len(shared) == 0:
+        return float(label_score)
+
+    mag_score = np.mean([np.exp(-abs(model_print['magnitudes'][var][1] - upload_print['magnitudes'][var][1]))
+                         for var in shared])
+    return float(LABEL_WEIGHT*label_score + (1-LABEL_WEIGHT)*mag_score)
+
+def rank(prints, upload_print, model_names):
+    """Get (score, model) pairs, best first, for given models."""
+    return sorted([(score(prints[name], upload_print), name) for name in model_names if name in prints], reverse=True)
+
+def update(project, model_name, upload_print):
+    """Merge accepted submission's fingerprint into model's fingerprint."""
+    index_dir, prints_path = path(project)
+
+    try:
+        load(project)  # Build fingerprints file from merged data, if needed
+    except FileNotFoundError:
+        log.warning(f'No merged data for "{project.name}", fingerprints start from this submission')
+        cache.shared_dir(index_dir)
+
+    with fp.lock, cache.locked(index_dir, True):
+        prints = read(prints_path) or {'source': None, 'models': {}}
+        old = prints['models'].setdefault(model_name, {'sketches': {}, 'magnitudes': {}})
+
+        for col in SKETCH_COLS:
+            new = upload_print['sketches'][col][0]
+            old['sketches'][col] = np.minimum(np.array(old['sketches'].get(col, new), dtype=np.uint64), new).tolist()
+
+        for var, (count, mean) in upload_print['magnitudes'].items():
+            old_count, old_mean = old['magnitudes'].get(var, [0, 0.0])
+            old['magnitudes'][var] = [old_count+count, (old_count*old_mean + count*mean) / (old_count+count)]
+
+        write(prints_path, prints)
+        fp.loaded.pop(project.name, None)
+
+def read(prints_path):
+
+    try:
+        with open(prints_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def write(prints_path, prints):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(prints_path), suffix='.tmp')
+
+    with os.fdopen(fd, 'w') as f:
+        json.dump(prints, f)
+
+    os.chmod(tmp, 0o664)
+    os.replace(tmp, prints_path)
@@ -1,19 +1,24 @@
 # model.py - Data access, rcampbel@purdue.edu, Oct 2023
 import os
 import csv
+import hashlib
+import json
 import sys
+import tempfile
 from fuzzywuzzy import fuzz, process
+import numpy as np
 import pandas as pd
+from nb import cache, fingerprint, store
 from nb.log import log
-from nb.config import HDR, SCN, REG, VAR, ITM, YRS, VAL, NUM_PREVIEW_ROWS  
+from nb.config import DEL, HDR, MOD, SCN, REG, VAR, ITM, YRS, VAL, NUM_PREVIEW_ROWS, EXPORT_CHUNK_ROWS
 
 FIX_TBL_SUFFIX = 'FixTable'
 FIX_COL = 'Fix'
+MANIFEST_EXT = '.json'
 
 model = sys.modules[__name__]
 
 # TODO Add check for min num cols in input data
-# TODO Add feature to guess model
 
 def start():
     """Prep model."""
@@ -22,17 +27,28 @@ def start():
     model.detected_delim = None
     model.path = None
     model.rules = None
+    model.project = None
+    model.upload_digest = None  # Hash of uploaded file (cache key)
+    model.rules_digest = None  # Hash of rules file (cache key)
+    model.parse_opts = None
+    model.read_columns = None  # Column names as read (before set_columns)
+    model.frame_cached = False
     model.num_rows_read = 0
     model.num_rows_ignored_scens = 0
+    model.ignored_mask = None  # Rows w/ignored scenarios (not removed from model.df)
+    model.ignore_opts = None
     model.bad_labels = None
     model.unknown_labels = None
+    model.row_groups = None  # Row counts per combination of unknown labels
+    model.upload_prints = {}  # Column map -> upload's fingerprint
     pd.set_option('display.width', 1000)  # Prevent data desc line breaks (for debug, if nothing else)
 
 def set_file(file_path):
     try:
         model.path = file_path if os.path.getsize(file_path) > 0 else None
+        model.upload_digest = cache.digest(model.path) if model.path is not None else None
     except OSError:
-        model.path = None
+        model.path, model.upload_digest = None, None
         raise
         
     return model.path is not None
@@ -54,8 +70,16 @@ def read_file(delim=None, skip=0, header='infer', ignore=[]):
         if not header == 'infer':
             header = skip + 0 if header else None
 
-        # TODO use diff dtype for VAL?
-        model.df = pd.read_csv(model.path, sep=delim, dtype='category', skiprows=skip, header=header, keep_default_na=False)
+        model.parse_opts = (delim, skip, header)
+        model.df = cached_frame()
+        model.frame_cached = model.df is not None
+
+        if model.df is None:
+            # TODO use diff dtype for VAL?
+            model.df = pd.read_csv(model.path, sep=delim, dtype='category', skiprows=skip, header=header, keep_default_na=False)
+
+        model.read_columns = model.df.columns.tolist()
+
         # log.debug(f'read_file(), category mem...\n{model.df.memory_usage(deep=True)}')
 
     except Exception:
@@ -63,10 +87,31 @@ def read_file(delim=None, skip=0, header='infer', ignore=[]):
         raise
 
     model.num_rows_read = len(model.df)
+    model.upload_prints = {}
     model.ignore_scenarios(ignore)
     return model.df is not None
 
+def cached_frame():
+    """Get previously parsed frame for same upload & parse options, if any."""
+    if model.project is None:
+        return None
+
+    return cache.get_frame(model.project, cache.key('frame', model.upload_digest, model.parse_opts))
+
+def cache_frame():
+    """Share parsed frame with later sessions. NOTE Only frames that get analyzed, not each parse option tried."""
+    if model.project is not None and not model.frame_cached:
+        model.frame_cached = True
+
+        try:
+            cache.put_frame(model.project, cache.key('frame', model.upload_digest, model.parse_opts), model.df,
+                            model.read_columns)
+        except Exception as e:
+            log.warning(f'Could not cache parsed data: "{e}"')
+
 def ignore_scenarios(ignore, scenario_col=None, remove=False):
+    model.ignore_opts = (tuple(ignore), scenario_col, remove)
+    model.ignored_mask = pd.Series(False, index=model.df.index)
     
     if len(ignore) > 0:
 
@@ -78,15 +123,18 @@ def ignore_scenarios(ignore, scenario_col=None, remove=False):
 
         if scenario_col is not None:
             # Filter using scen col & ignore list 
-            filtered_df = model.df[~model.df[scenario_col].isin(ignore)]
+            ignored_mask = model.df[scenario_col].isin(ignore)
+            filtered_df = model.df[~ignored_mask]
 
             # Save count for integrity tab
             model.num_rows_ignored_scens = len(model.df) - len(filtered_df)
 
             if remove:
                 model.df = filtered_df.reset_index(drop=True)
+                model.ignored_mask = pd.Series(False, index=model.df.index)
                 model.preview_df = model.df.head(NUM_PREVIEW_ROWS)
             else:
+                model.ignored_mask = ignored_mask
                 model.preview_df = filtered_df.copy().reset_index(drop=True).head(NUM_PREVIEW_ROWS) 
     
     else:
@@ -98,7 +146,10 @@ def has_header():
 
 def load_rules(project):
     """Read all rules from worksheets in project's xlsx file."""
-    model.rules = pd.read_excel(os.path.join(project.base, project.rule_file), sheet_name=None, dtype=str, keep_default_na=False)
+    path = os.path.join(project.base, project.rule_file)
+    model.rules = pd.read_excel(path, sheet_name=None, dtype=str, keep_default_na=False)
+    model.rules_digest = cache.digest(path)
+    model.project = project
 
 def all_models():
     return list(model.rules['ModelTable']['Model']) 
@@ -114,9 +165,41 @@ def set_columns(col_map):
     log.debug(f'set_columns(), col_map={col_map}, columns={model.df.columns}, df: ...\n{model.df}')
 
 def analyze():
-    "Create row counts, bad label list, unknown label list."
-    model.num_rows_with_nan = model.df.isna().any(axis=1).sum()  # Row count: Structural problems
-    model.duplicate_rows = model.df.duplicated().sum()  # Row count: Duplicate rows
+    "Create row counts, bad label list, unknown label list - reuse earlier results for same upload & rules."
+    cache_frame()
+    cache_key = cache.key('analysis', model.upload_digest, model.parse_opts, model.ignore_opts, model.df.columns.tolist(),
+                          model.rules_digest)
+    result = cache.get_result(model.project, cache_key) if model.project is not None else None
+
+    if result is None:
+        find_problems()
+
+        if model.project is not None:
+
+            try:
+                cache.put_result(model.project, cache_key, {'num_rows_with_nan': int(model.num_rows_with_nan),
+                                                            'duplicate_rows': int(model.duplicate_rows),
+                                                            'bad_labels': model.bad_labels,
+                                                            'unknown_labels': model.unknown_labels,
+                                                            'row_groups': model.row_groups})
+            except Exception as e:
+                log.warning(f'Could not cache analysis: "{e}"')
+    else:
+        model.num_rows_with_nan = result['num_rows_with_nan']
+        model.duplicate_rows = result['duplicate_rows']
+        model.bad_labels = [tuple(label) for label in result['bad_labels']]
+        model.unknown_labels = [tuple(label) for label in result['unknown_labels']]
+        model.row_groups = [(tuple(tuple(label) for label in labels), rows, nans, dupes)
+                            for labels, rows, nans, dupes in result['row_groups']]
+        log.debug('analyze(), using cached results')
+
+def find_problems():
+    "Scan data for row counts, bad labels, unknown labels."
+    # NOTE Row classes don't overlap: ignored, else structural problem, else duplicate 
+    nan_mask = model.df.isna().any(axis=1) & ~model.ignored_mask
+    dupe_mask = duplicated_rows() & ~model.ignored_mask & ~nan_mask
+    model.num_rows_with_nan = nan_mask.sum()  # Row count: Structural problems
+    model.duplicate_rows = dupe_mask.sum()  # Row count: Duplicate rows
     model.bad_labels, model.unknown_labels = [], []
 
     # Process output data by column - except values col
@@ -155,6 +238,103 @@ def analyze():
     for label in non_num_unique:
         model.bad_labels.append((VAL, label, '0'))  # NOTE Hardcode zero TODO Verify      
 
+    count_labels(nan_mask, dupe_mask)
+
+def duplicated_rows():
+    """Mark repeats of earlier rows. NOTE Compares one hash per row (of category codes), unlike DataFrame.duplicated()
+    which factorizes every column into int64 arrays."""
+    codes = pd.DataFrame({i: col.cat.codes if isinstance(col.dtype, pd.CategoricalDtype) else col 
+                          for i, (_, col) in enumerate(model.df.items())}, index=model.df.index)
+    return pd.util.hash_pandas_object(codes, index=False).duplicated()
+
+def count_labels(nan_mask, dupe_mask):
+    """Count rows per combination of unknown labels (allows tallying deletions w/o rescanning data), except ignored rows."""
+    cols = sorted({col for col, _, _ in model.unknown_labels})
+    labels = {col: [lbl for c, lbl, _ in model.unknown_labels if c == col] for col in cols}
+    groups = {}
+
+    if len(cols) > 0:
+        codes = {}
+
+        for col in cols:
+            # Map category codes to unknown label index (-1: not unknown, incl. missing value's code)
+            index = {lbl: i for i, lbl in enumerate(labels[col])}
+            lookup = np.array([index.get(cat, -1) for cat in model.df[col].cat.categories] + [-1])
+            codes[col] = lookup[model.df[col].cat.codes.to_numpy()]
+
+        frame = pd.DataFrame(codes)
+        frame['nan'], frame['dupe'] = nan_mask.to_numpy(), dupe_mask.to_numpy()
+        frame = frame[~model.ignored_mask.to_numpy()]  # NOTE Already subtracted from accepted rows
+
+        for key, n in frame.groupby(list(frame.columns)).size().items():
+            group = tuple((col, labels[col][code]) for col, code in zip(cols, key[:-2]) if code >= 0)
+
+            if len(group) > 0:
+                rows, nans, dupes = groups.get(group, (0, 0, 0))
+                groups[group] = (rows + int(n), nans + int(n)*bool(key[-2]), dupes + int(n)*bool(key[-1]))
+
+    model.row_groups = [(group, rows, nans, dupes) for group, (rows, nans, dupes) in groups.items()]
+
+def tally_reset():
+    """Start tallying rows deleted by user's fix choices."""
+    model.deleted_labels = set()
+    model.group_deletions = [0] * len(model.row_groups)  # Num. deleted labels per row group
+    model.label_groups = {}  # Label -> indexes of row groups containing label
+    model.deleted_rows, model.deleted_nans, model.deleted_dupes = 0, 0, 0
+
+    for i, (group, _, _, _) in enumerate(model.row_groups):
+
+        for label in group:
+            model.label_groups.setdefault(label, []).append(i)
+
+def tally(col, lbl, fix):
+    """Update deleted row counts for label's new fix - only visits row groups containing label."""
+    delete = fix == DEL
+
+    if delete == ((col, lbl) in model.deleted_labels):
+        return
+
+    step = 1 if delete else -1
+
+    if delete:
+        model.deleted_labels.add((col, lbl))
+    else:
+        model.deleted_labels.discard((col, lbl))
+
+    for i in model.label_groups.get((col, lbl), []):
+        was_deleted = model.group_deletions[i] > 0
+        model.group_deletions[i] += step
+
+        if was_deleted != (model.group_deletions[i] > 0):  # Rows deleted by this label only
+            _, rows, nans, dupes = model.row_groups[i]
+            model.deleted_rows += step*rows
+            model.deleted_nans += step*nans
+            model.deleted_dupes += step*dupes
+
+def row_counts():
+    """Get current row counts: structural problems, duplicates, deleted, accepted."""
+    nans = model.num_rows_with_nan - model.deleted_nans
+    dupes = model.duplicate_rows - model.deleted_dupes
+    accepted = model.num_rows_read - model.num_rows_ignored_scens - nans - dupes - model.deleted_rows
+    return nans, dupes, model.deleted_rows, accepted
+
+def upload_print(col_map=None):
+    """Get (once per column assignment) fingerprint of uploaded data."""
+    key = None if col_map is None else tuple(sorted(col_map.items()))
+
+    if key not in model.upload_prints:
+        model.upload_prints[key] = fingerprint.of_frame(model.df, col_map)
+
+    return model.upload_prints[key]
+
+def rank_models(col_map=None):
+    """Get (score, model) pairs, best match w/upload first."""
+    return fingerprint.rank(fingerprint.load(model.project), model.upload_print(col_map), all_models())
+
+def learn_model(model_name, col_map):
+    """Add accepted submission to model's fingerprint."""
+    fingerprint.update(model.project, model_name, fingerprint.of_frame(model.df, col_map))
+
 def get_valid(col): 
     return sorted(model.rules[col+'Table'][col].tolist())
 
@@ -179,3 +359,55 @@ def select(scn, reg, var):
     subset.set_index(YRS, inplace=True)
     return subset.groupby(ITM)[VAL]    
 
+def compare(scn, reg, var, exclude_model):
+    """Get other models' value range (min, max) per item & year from project's merged data (None if not ready yet)."""
+    others = store.query(model.project, {SCN: scn, REG: reg, VAR: var}, [MOD, ITM, YRS, VAL], wait=False)
+
+    if others is None:
+        return None
+
+    others = others[others[MOD] != exclude_model].dropna(subset=[YRS, VAL])
+    others = others.assign(**{YRS: others[YRS].astype(int)})
+    return others.groupby([ITM, YRS], observed=True)[VAL].agg(['min', 'max'])
+
+def export(path, model_name, info={}, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Stream accepted rows to CSV file in chunks, then write manifest - both appear atomically (via temp file & rename).
+    NOTE Manifest is written last: consumers must wait for it before reading CSV file."""
+    sha, num_rows = hashlib.sha256(), 0
+    ignored = model.ignored_mask.reindex(model.df.index, fill_value=False).to_numpy()
+    rejected = ignored | model.df.isna().any(axis=1).to_numpy() | duplicated_rows().to_numpy()
+    accepted = np.flatnonzero(~rejected)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            data = pd.DataFrame(columns=HDR).to_csv(index=False).encode()  # Header row
+            sha.update(data)
+            f.write(data)
+
+            for start in range(0, len(accepted), chunk_rows):
+                chunk = model.df.iloc[accepted[start:start+chunk_rows]]  # NOTE Only chunk gets copied
+                data = chunk[HDR[1:]].assign(**{MOD: model_name})[HDR].to_csv(index=False, header=False).encode()
+                sha.update(data)
+                f.write(data)
+                num_rows += len(chunk)
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.chmod(tmp, 0o664)
+        os.replace(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+    manifest = dict(info, file=os.path.basename(path), model=model_name, rows=num_rows, columns=HDR, sha256=sha.hexdigest())
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    os.chmod(tmp, 0o664)
+    os.replace(tmp, os.path.splitext(path)[0]+MANIFEST_EXT)
+    log.debug(f'export(), manifest={manifest}')
+    return manifest
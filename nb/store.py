@@ -0,0 +1,227 @@
+# store.py - Indexed access to merged project data, rcampbel@purdue.edu, Oct 2023
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import traceback
+from itertools import product
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+from nb import cache
+from nb.log import log
+from nb.config import HDR, MOD, SCN, REG, VAR, ITM, UNI, YRS, VAL, INDEX_CHUNK_ROWS
+
+LABEL_COLS = [MOD, SCN, REG, VAR, ITM, UNI]  # Stored as category codes
+NUM_COLS = [YRS, VAL]  # Stored as floats
+KEY_COLS = [SCN, REG, VAR, ITM]  # Rows sorted & indexed by these
+KEY_FILE = 'key.npy'  # Sorted combined key codes (row index)
+META_FILE = 'meta.json'
+VERSION = 2  # Bump when layout of stored data changes
+
+store = sys.modules[__name__]
+store.loaded = {}  # Project name -> meta, dtypes, arrays (memory mapped)
+store.lock = threading.Lock()
+store.refreshing = set()  # Names of projects w/store being (re)opened in background
+
+def paths(project):
+    """Get paths of merged data file, index dir, & project's store within index dir."""
+    index_dir = os.path.join(project.base, project.index_dir)
+    return (os.path.join(project.base, project.merge_file), index_dir,
+            os.path.join(index_dir, os.path.splitext(os.path.basename(project.merge_file))[0]))
+
+def load(project, wait=True):
+    """Open project's store, (re)building it if merged data file has changed.
+    If not waiting: refresh in background, meanwhile get previously opened store (or None)."""
+    source, index_dir, path = paths(project)
+    stat = os.stat(source)
+    signature = [stat.st_size, stat.st_mtime_ns]
+    data = store.loaded.get(project.name)
+
+    if data is not None and data['meta']['source'] == signature:
+        return data
+
+    if not wait:
+
+        if project.name not in store.refreshing:
+            store.refreshing.add(project.name)
+            log.info(f'Refreshing "{source}" index, other models\' data ' +
+                     ('may be outdated' if data is not None else 'unavailable') + ' until done')
+            threading.Thread(target=refresh, args=(project,), daemon=True).start()
+
+        return data
+
+    with store.lock:
+        data = store.loaded.get(project.name)
+
+        if data is not None and data['meta']['source'] == signature:
+            return data  # Opened while waiting
+
+        with cache.locked(cache.shared_dir(index_dir), True):
+            meta = read_meta(path)
+
+            if meta is None or meta['source'] != signature or meta.get('version') != VERSION:
+                build(source, index_dir, path, signature)
+                meta = read_meta(path)
+
+            data = {'meta': meta,
+                    'dtypes': {col: pd.CategoricalDtype(meta['categories'][col]) for col in LABEL_COLS},
+                    'arrays': {col: np.load(os.path.join(path, col+'.npy'), mmap_mode='r') for col in HDR},
+                    'key': np.load(os.path.join(path, KEY_FILE), mmap_mode='r')}
+
+        store.loaded[project.name] = data  # NOTE Replaces (doesn't close) old store, may still be in use
+        return data
+
+def refresh(project):
+    """(Re)open project's store in background."""
+    try:
+        load(project)
+    except Exception:
+        log.error('refresh:\n'+traceback.format_exc())
+    finally:
+        store.refreshing.discard(project.name)
+
+def strides(meta):
+    """Get multiplier of each key column's codes in combined key (+1 per column for missing labels' code -1)."""
+    sizes = [len(meta['categories'][col])+1 for col in KEY_COLS]
+    return [int(np.prod(sizes[i+1:], dtype=np.int64)) for i in range(len(KEY_COLS))]
+
+def read_meta(path):
+
+    try:
+        with open(os.path.join(path, META_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def build(source, index_dir, path, signature):
+    """Convert merged data to sorted column files, plus index of key labels -> row range."""
+    log.info(f'Indexing "{source}"...')
+    parts = {col: [] for col in HDR}
+    dtypes = dict({col: 'category' for col in LABEL_COLS}, **{col: str for col in NUM_COLS})
+
+    for chunk in pd.read_csv(source, usecols=HDR, dtype=dtypes, keep_default_na=False, chunksize=INDEX_CHUNK_ROWS):
+
+        for col in LABEL_COLS:
+            parts[col].append(chunk[col].values)
+
+        for col in NUM_COLS:
+            parts[col].append(pd.to_numeric(chunk[col], errors='coerce').to_numpy(dtype=float))
+
+    labels = {col: union_categoricals(parts[col]) if parts[col] else pd.Categorical([]) for col in LABEL_COLS}
+    codes = {col: labels[col].codes for col in LABEL_COLS}
+    num_rows = len(codes[MOD])
+    meta = {'source': signature, 'rows': num_rows, 'version': VERSION,
+            'categories': {col: labels[col].categories.tolist() for col in LABEL_COLS}}
+
+    # Combined key: sorting by it sorts by scenario, then region, variable, item
+    key = np.zeros(num_rows, dtype=np.int64)
+
+    for col, stride in zip(KEY_COLS, strides(meta)):
+        key += (codes[col].astype(np.int64)+1) * stride
+
+    order = np.argsort(key, kind='stable')
+    tmp = tempfile.mkdtemp(dir=index_dir)
+
+    try:
+        for col in LABEL_COLS:
+            np.save(os.path.join(tmp, col+'.npy'), codes[col][order])
+
+        for col in NUM_COLS:
+            np.save(os.path.join(tmp, col+'.npy'), np.concatenate(parts[col])[order] if parts[col] else np.array([]))
+
+        np.save(os.path.join(tmp, KEY_FILE), key[order])
+
+        with open(os.path.join(tmp, META_FILE), 'w') as f:
+            json.dump(meta, f)
+
+        for name in os.listdir(tmp):
+            os.chmod(os.path.join(tmp, name), 0o664)
+
+        os.chmod(tmp, 0o2775)
+
+        # Swap in new store NOTE Sessions with old store open keep reading old (memory mapped) files
+        if os.path.exists(path):
+            old = tempfile.mkdtemp(dir=index_dir)
+            os.replace(path, os.path.join(old, 'store'))
+            os.replace(tmp, path)
+            shutil.rmtree(old, ignore_errors=True)  # NOTE Old files still open elsewhere may linger (e.g. NFS)
+        else:
+            os.replace(tmp, path)
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+    log.info(f'Indexed {num_rows} rows from "{source}"')
+
+def find_ranges(data, where):
+    """Get sorted, merged row ranges matching criteria for leading key columns, plus key columns left to filter."""
+    prefix = []
+
+    for col in KEY_COLS:
+
+        if col not in where:
+            break
+
+        prefix.append(col)
+
+    if len(prefix) == 0:
+        return [[0, data['meta']['rows']]], prefix
+
+    # Search sorted key for each combination of wanted labels (+1: missing label's code -1 is 0 in key)
+    codes = [[code+1 for code in data['dtypes'][col].categories.get_indexer(as_list(where[col])) if code >= 0] 
+             for col in prefix]
+    key_strides = strides(data['meta'])
+    bounds = []
+
+    for combo in product(*codes):
+        low = sum(code*stride for code, stride in zip(combo, key_strides))
+        high = low + key_strides[len(prefix)-1]
+        bounds.append((low, high))
+
+    ranges = []
+    starts = np.searchsorted(data['key'], [low for low, _ in bounds], side='left')
+    stops = np.searchsorted(data['key'], [high for _, high in bounds], side='left')
+
+    for start, stop in sorted(zip(starts.tolist(), stops.tolist())):
+
+        if start == stop:
+            continue
+
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = stop
+        else:
+            ranges.append([start, stop])
+
+    return ranges, prefix
+
+def as_list(labels):
+    return list(labels) if isinstance(labels, (list, tuple, set)) else [labels]
+
+def query(project, where={}, columns=HDR, wait=True):
+    """Get project's merged data, only rows matching `where` ({column: label(s)}) & only given columns (None if not waiting & not ready)."""
+    data = load(project, wait)
+
+    if data is None:
+        return None
+
+    ranges, prefix = find_ranges(data, where)
+    filters = {col: labels for col, labels in where.items() if col not in prefix}
+    df = pd.DataFrame({col: take(data, col, ranges) for col in list(columns) + [col for col in filters if col not in columns]})
+
+    for col, labels in filters.items():
+        df = df[df[col].isin(as_list(labels))]
+
+    return df[list(columns)].reset_index(drop=True)
+
+def take(data, col, ranges):
+    """Read row ranges of column."""
+    array = data['arrays'][col]
+    values = np.concatenate([array[start:stop] for start, stop in ranges]) if ranges else np.array(array[:0])
+
+    if col in LABEL_COLS:
+        return pd.Categorical.from_codes(values, dtype=data['dtypes'][col])
+
+    return values
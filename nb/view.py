@@ -98,6 +98,7 @@ def submission_screen():
 
     # Assign model (incl. spacer)
     view.model_ddn = Dropdown()
+    view.model_hint_lbl = Label()
     cols = [Label(value=MOD)]
     widgets = [view.model_ddn]
 
@@ -118,7 +119,7 @@ def submission_screen():
     view.out_grid = GridBox(children=labels, layout=Layout(grid_template_columns=f'repeat({len(HDR)}, 1fr)', grid_gap='0px'))
 
     content += [section('b) Assign model and columns for submission', 
-                        [VBox([HBox(cols), HBox(widgets), Label('Submission preview:'), view.out_grid])])]
+                        [VBox([HBox(cols), HBox(widgets), view.model_hint_lbl, Label('Submission preview:'), view.out_grid])])]
 
     return VBox(content)
 
@@ -129,8 +130,9 @@ def integrity_screen():
     view.struct_probs_int = Text(description='Structural problems (e.g. missing fields)', disabled=True)
     view.ignored_scens_int = Text(description='Ignored scenarios', disabled=True)
     view.dupes_int = Text(description='Duplicate records', disabled=True)
+    view.deleted_int = Text(description='Deleted records (see unknown labels)', disabled=True)
     view.accepted_int = Text(description='Accepted records', disabled=True)
-    widgets = [view.struct_probs_int, view.ignored_scens_int, view.dupes_int, view.accepted_int]
+    widgets = [view.struct_probs_int, view.ignored_scens_int, view.dupes_int, view.deleted_int, view.accepted_int]
     set_width(widgets, '460px')
     set_width(widgets, '300px',  desc=True)
     content = [section('a) Review analysis', widgets, 'Classifications and row counts:')]
@@ -180,8 +182,8 @@ def title(text):
     """Create header text for use within grid."""
     return Label(value=text)
 
-def display_plot(data):
-    """Ask data to plot itself then show that plot."""
+def display_plot(data, bands=None):
+    """Ask data to plot itself then show that plot, with optional range of other models' values (min, max per item & year)."""
     with view.plot_area:
         clear_output(wait=True)
 
@@ -190,6 +192,17 @@ def display_plot(data):
         else:  # data is a pandas dataframe
             _, ax = plt.subplots()
             data.plot(title='Value Trends', xlabel=YRS, ylabel=VAL, legend=True, grid=True, figsize=(10, 5))
+
+            if bands is not None:
+                colors = {line.get_label(): line.get_color() for line in ax.get_lines()}
+
+                bands = bands[bands.index.get_level_values(0).astype(str).isin(colors)]  # Only submitted items
+
+                for i, (item, band) in enumerate(bands.groupby(level=0, observed=True)):
+                    band = band.droplevel(0)
+                    ax.fill_between(band.index, band['min'], band['max'], color=colors[str(item)], alpha=0.15,
+                                    label='Other models (range)' if i == 0 else None)
+
             ax.legend(loc='center left', bbox_to_anchor=(1.0, 0.5)) # Move legend outside plot area
             plt.show()
 